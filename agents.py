@@ -1 +1,666 @@
+"""Bedrock-backed agents for roadside-assistance transcript analysis.
 
+Each agent wraps one prompt and one call pattern against Claude on Bedrock.
+Timeline extraction and root-cause analysis are fused into a single agent
+(``CombinedAnalysisAgent``) so every transcript costs exactly one invocation:
+the transcript text is sent once and the model returns the timeline and the
+root-cause fields in one JSON object.
+"""
+
+import json
+import logging
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import aioboto3
+import msgspec
+import orjson
+from aiolimiter import AsyncLimiter
+from botocore.exceptions import ClientError
+from tenacity import (
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Throttling is the expected failure mode when concurrency approaches the
+# TPM quota; retrying these (and only these) converts dropped transcripts
+# into sustained throughput near the quota.
+_RETRYABLE_ERROR_CODES = (
+    "ThrottlingException",
+    "ModelTimeoutException",
+    "ServiceUnavailableException",
+)
+
+
+def _supports_latency_optimized(model_id: str) -> bool:
+    return model_id.startswith(config.LATENCY_OPTIMIZED_MODEL_PREFIXES)
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    return (
+        isinstance(exc, ClientError)
+        and exc.response.get("Error", {}).get("Code") in _RETRYABLE_ERROR_CODES
+    )
+
+
+# msgspec.Struct models: validation and (de)serialization run in C, which
+# matters when 100k transcripts are decoded before any LLM work starts.
+
+
+class Transcript(msgspec.Struct):
+    transcript_id: str
+    content: str
+    call_date: Optional[str] = None
+
+
+class TimelineEvent(msgspec.Struct):
+    description: str
+    timestamp: Optional[str] = None
+
+
+class AnalysisResult(msgspec.Struct):
+    transcript_id: str
+    root_cause: str
+    root_cause_category: str
+    sentiment: str
+    summary: str
+    timeline: List[TimelineEvent] = []
+    actionable_insight: Optional[str] = None
+
+
+class BedrockClient:
+    """Async wrapper around the bedrock-runtime Converse API.
+
+    The hot path is pure network I/O, so calls go through aioboto3 on a
+    single event loop instead of burning a blocked thread per in-flight
+    request. Use as an async context manager; one underlying aiohttp client
+    is shared by every concurrent call.
+    """
+
+    def __init__(self, region: str = config.AWS_REGION):
+        self._session = aioboto3.Session()
+        self._region = region
+        self._client_cm = None
+        self._client = None
+        # Token bucket shared by every concurrent call, sized so the steady
+        # state sits just under the account's TPM quota instead of bouncing
+        # off ThrottlingException.
+        self._limiter = AsyncLimiter(
+            config.TPM_QUOTA / config.AVG_TOKENS_PER_CALL, time_period=60
+        )
+
+    async def __aenter__(self) -> "BedrockClient":
+        self._client_cm = self._session.client(
+            "bedrock-runtime", region_name=self._region
+        )
+        self._client = await self._client_cm.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self._client_cm.__aexit__(exc_type, exc, tb)
+        self._client = None
+
+    @staticmethod
+    def build_request_body(
+        prompt: str,
+        system_prompt: str = "",
+        max_tokens: int = 1024,
+        tool_spec: Optional[dict] = None,
+    ) -> dict:
+        """Request body for InvokeModel; also used as batch-job modelInput."""
+        body = {
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": max_tokens,
+            "temperature": config.TEMPERATURE,
+            "messages": [{"role": "user", "content": prompt}],
+        }
+        if system_prompt:
+            body["system"] = system_prompt
+        if tool_spec:
+            body["tools"] = [
+                {
+                    "name": tool_spec["name"],
+                    "description": tool_spec.get("description", ""),
+                    "input_schema": tool_spec["inputSchema"]["json"],
+                }
+            ]
+            body["tool_choice"] = {"type": "tool", "name": tool_spec["name"]}
+        return body
+
+    @retry(
+        retry=retry_if_exception(_is_retryable),
+        wait=wait_exponential_jitter(initial=1, max=30),
+        stop=stop_after_attempt(6),
+        reraise=True,
+    )
+    async def ainvoke_model(
+        self,
+        prompt: str,
+        system_prompt: str = "",
+        cached_prefix: str = "",
+        max_tokens: Optional[int] = None,
+        model_id: Optional[str] = None,
+        tool_spec: Optional[dict] = None,
+    ) -> "str | dict":
+        """Invoke the model through the Converse API.
+
+        ``cached_prefix`` is a static instruction block that is identical
+        across calls; it goes into the system blocks followed by a
+        ``cachePoint`` so Bedrock serves those tokens from the prompt cache
+        on every call after the first. Only ``prompt`` varies per call.
+
+        ``max_tokens`` defaults to None so Bedrock reserves only the model
+        default against the TPM quota: the quota burndown counts
+        input + maxTokens at request start, so a generous cap throttles
+        concurrent workers long before any tokens are generated. Agents pass
+        a budget sized to their actual output.
+
+        ``model_id`` lets each agent route to the cheapest model capable of
+        its task; unset, it falls back to the analysis model.
+
+        With ``tool_spec`` set, the call forces that tool and returns its
+        schema-valid input dict: no code fences, no JSON repair, and no
+        output tokens wasted on formatting.
+        """
+        system = []
+        if system_prompt:
+            system.append({"text": system_prompt})
+        if cached_prefix:
+            system.append({"text": cached_prefix})
+            system.append({"cachePoint": {"type": "default"}})
+        model = model_id or config.ANALYSIS_MODEL
+        kwargs = {}
+        if config.LATENCY_OPTIMIZED and _supports_latency_optimized(model):
+            kwargs["performanceConfig"] = {"latency": "optimized"}
+        if tool_spec:
+            kwargs["toolConfig"] = {
+                "tools": [{"toolSpec": tool_spec}],
+                "toolChoice": {"tool": {"name": tool_spec["name"]}},
+            }
+        await self._limiter.acquire()
+        response = await self._client.converse(
+            modelId=model,
+            system=system,
+            messages=[{"role": "user", "content": [{"text": prompt}]}],
+            inferenceConfig={
+                **({"maxTokens": max_tokens} if max_tokens else {}),
+                "temperature": config.TEMPERATURE,
+            },
+            **kwargs,
+        )
+        content = response["output"]["message"]["content"]
+        if tool_spec:
+            for block in content:
+                if "toolUse" in block:
+                    return block["toolUse"]["input"]
+        return content[0]["text"]
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    # Imported lazily; the tokenizer is only needed for long transcripts.
+    import tiktoken
+
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def _truncate_transcript(content: str) -> str:
+    """Clip long transcripts to a head+tail token window.
+
+    Roadside-assistance calls concentrate their signal in the opening
+    problem description and the closing resolution; the middle small talk
+    adds input tokens (and TPM burndown) without improving the analysis.
+    Transcripts under TRANSCRIPT_TOKEN_LIMIT pass through untouched.
+    """
+    enc = _encoding()
+    tokens = enc.encode(content)
+    if len(tokens) <= config.TRANSCRIPT_TOKEN_LIMIT:
+        return content
+    head = enc.decode(tokens[: config.TRANSCRIPT_HEAD_TOKENS])
+    tail = enc.decode(tokens[-config.TRANSCRIPT_TAIL_TOKENS :])
+    return f"{head}\n...[middle omitted]...\n{tail}"
+
+
+def _parse_json_response(response_text: str) -> dict:
+    """Strip code fences the model sometimes adds and parse the JSON body."""
+    cleaned = response_text.replace("```json", "").replace("```", "").strip()
+    return orjson.loads(cleaned)
+
+
+_RESULT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "timeline": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "description": {"type": "string"},
+                    "timestamp": {"type": ["string", "null"]},
+                },
+                "required": ["description"],
+            },
+        },
+        "root_cause": {"type": "string"},
+        "root_cause_category": {"type": "string"},
+        "sentiment": {
+            "type": "string",
+            "enum": ["positive", "neutral", "negative"],
+        },
+        "summary": {"type": "string"},
+        "actionable_insight": {"type": ["string", "null"]},
+    },
+    "required": [
+        "timeline",
+        "root_cause",
+        "root_cause_category",
+        "sentiment",
+        "summary",
+    ],
+}
+
+# Worked example embedded in the cached instruction prefix.
+_EXAMPLE_RESULT = json.dumps(
+    {
+        "timeline": [
+            {
+                "timestamp": "2:15 PM",
+                "description": "Customer reports a flat tire on the highway shoulder.",
+            },
+            {
+                "timestamp": None,
+                "description": "Agent dispatches a provider with a 45-minute ETA.",
+            },
+            {
+                "timestamp": "3:40 PM",
+                "description": "Customer calls back because the provider has not arrived.",
+            },
+        ],
+        "root_cause": "The assigned provider exceeded the quoted ETA by 40 minutes without any update to the customer.",
+        "root_cause_category": "Provider Delay",
+        "sentiment": "negative",
+        "summary": "A customer with a flat tire waited well past the quoted ETA and called back frustrated. The agent apologized and re-dispatched a second provider.",
+        "actionable_insight": "Send proactive ETA-update notifications when a provider is running late.",
+    },
+    indent=2,
+)
+
+
+class CombinedAnalysisAgent:
+    """Extracts the call timeline and root-cause analysis in one invocation.
+
+    The timeline is intermediate reasoning for the root-cause judgment, so
+    asking for both in a single response halves the request count and avoids
+    billing the transcript text twice.
+    """
+
+    SYSTEM_PROMPT = (
+        "You are an expert analyst of roadside-assistance call transcripts. "
+        "You extract factual event timelines and diagnose the root cause of "
+        "the customer's issue. Record results with the provided tool."
+    )
+
+    # Output budget per transcript; the JSON result is well under this.
+    MAX_TOKENS = 800
+
+    # Root-cause diagnosis needs judgment; this stays on the stronger model.
+    # (Timeline extraction is fused into the same call, so there is no
+    # separate mechanical invocation left to route to a cheaper model.)
+    MODEL_ID = config.ANALYSIS_MODEL
+
+    # Forced tool calls make the model emit schema-valid JSON directly.
+    TOOL_SPEC = {
+        "name": "record_analysis",
+        "description": "Record the analysis of one call transcript.",
+        "inputSchema": {"json": _RESULT_SCHEMA},
+    }
+    BATCH_TOOL_SPEC = {
+        "name": "record_batch_analysis",
+        "description": "Record the analysis of every case in the batch.",
+        "inputSchema": {
+            "json": {
+                "type": "object",
+                "properties": {
+                    "results": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "transcript_id": {"type": "string"},
+                                **_RESULT_SCHEMA["properties"],
+                            },
+                            "required": ["transcript_id"]
+                            + _RESULT_SCHEMA["required"],
+                        },
+                    }
+                },
+                "required": ["results"],
+            }
+        },
+    }
+
+    def __init__(self, client: BedrockClient):
+        # The caller owns the client: it must be entered (``async with``)
+        # before any invocation, so agents share one entered instance
+        # instead of constructing their own unentered one.
+        self.client = client
+        # Static instruction blocks, identical for every call. They are sent
+        # as the cached prefix in live mode and prepended to the prompt in
+        # batch-inference manifests. Sonnet only caches system prefixes of at
+        # least 1024 tokens, so the full tool schema, the category glossary,
+        # the per-field rubrics, and a worked example live here instead of in
+        # the per-call prompt; that pushes the prefix well past the minimum,
+        # and every one of those tokens is cache-served after the first call.
+        categories = "\n".join(
+            f"- {label}: {description}"
+            for label, description in config.CATEGORY_DESCRIPTIONS.items()
+        )
+        steps = f"""Step 1 - Timeline: extract a chronological timeline of the key events in the
+call. Each event has an optional "timestamp" (as stated in the transcript, or
+null) and a one-sentence "description". Order events as they happened, not as
+they are mentioned. Aim for three to eight events: enough to follow how the
+call unfolded, without recording every conversational turn. A transcript may
+carry an "...[middle omitted]..." marker where its middle was clipped; never
+invent events for the omitted span.
+
+Step 2 - Root cause: using the timeline you extracted, determine the root
+cause of the customer's issue, the customer's overall sentiment, a short
+summary of the call, and one actionable insight for the business (or null).
+
+"root_cause" names, in one or two sentences, the underlying problem that
+triggered the call - the originating issue, not a downstream symptom (a tow
+requested because the engine seized is an engine failure, not a towing
+problem).
+
+"sentiment" reflects the customer's state over the call as a whole:
+- "positive": the issue was resolved to the customer's satisfaction, or the
+  customer expresses gratitude or relief.
+- "neutral": a routine service call with no notable frustration or praise.
+- "negative": the customer expresses frustration or dissatisfaction, or the
+  call ends with the issue unresolved.
+
+"summary" is two to three sentences covering why the customer called, what
+happened during the call, and how it ended.
+
+"actionable_insight" is one concrete process or product improvement this
+specific call suggests; use null when the call suggests none.
+
+CRITICAL INSTRUCTION: "root_cause_category" must be a short label for the
+root cause. Use one of the recommended categories below whenever it fits;
+only introduce a new category when none of them applies.
+
+Recommended Categories:
+{categories}
+
+Example of one completed analysis (shape and register; adapt every value to
+the transcript at hand):
+{_EXAMPLE_RESULT}"""
+        self._instructions = f"""Analyze the roadside-assistance call transcript the user provides.
+
+{steps}
+
+Call the record_analysis tool once with the result. The tool input must
+validate against this JSON schema:
+{json.dumps(_RESULT_SCHEMA, indent=2)}"""
+        self._batch_instructions = f"""Analyze each roadside-assistance call transcript the user provides.
+Each transcript is delimited by <<<CASE id=...>>> and <<<END>>> markers.
+Analyze every case independently.
+
+For each case:
+
+{steps}
+
+Call the record_batch_analysis tool once with a "results" array holding one
+object per case, in any order; each object adds the "transcript_id" from its
+CASE marker to the fields above. The tool input must validate against this
+JSON schema:
+{json.dumps(self.BATCH_TOOL_SPEC["inputSchema"]["json"], indent=2)}"""
+
+    @staticmethod
+    def _transcript_block(transcript: Transcript) -> str:
+        return f"Transcript:\n{_truncate_transcript(transcript.content)}"
+
+    @staticmethod
+    def _case_blocks(transcripts: List[Transcript]) -> str:
+        return "\n\n".join(
+            f"<<<CASE id={t.transcript_id}>>>\n"
+            f"{_truncate_transcript(t.content)}\n<<<END>>>"
+            for t in transcripts
+        )
+
+    @staticmethod
+    def _result_from_dict(transcript_id: str, data: dict) -> AnalysisResult:
+        timeline = [
+            msgspec.convert(event, TimelineEvent, strict=False)
+            for event in data.get("timeline", [])
+            if isinstance(event, dict) and event.get("description")
+        ]
+        return AnalysisResult(
+            transcript_id=transcript_id,
+            timeline=timeline,
+            root_cause=data.get("root_cause", "Unknown"),
+            root_cause_category=data.get("root_cause_category", "Other"),
+            sentiment=data.get("sentiment", "neutral"),
+            summary=data.get("summary", ""),
+            actionable_insight=data.get("actionable_insight"),
+        )
+
+    def build_model_input(self, transcript: Transcript) -> dict:
+        """The modelInput record for a Bedrock batch-inference manifest."""
+        prompt = f"{self._instructions}\n\n{self._transcript_block(transcript)}"
+        return self.client.build_request_body(
+            prompt,
+            self.SYSTEM_PROMPT,
+            max_tokens=self.MAX_TOKENS,
+            tool_spec=self.TOOL_SPEC,
+        )
+
+    def parse_response(self, transcript_id: str, response_text: str) -> AnalysisResult:
+        """Turn a raw text model response into an AnalysisResult.
+
+        Only a fallback: forced tool calls return the payload dict directly.
+        """
+        try:
+            data = _parse_json_response(response_text)
+        except orjson.JSONDecodeError:
+            logger.warning(
+                "Malformed JSON for transcript %s, using defaults", transcript_id
+            )
+            data = {}
+        return self._result_from_dict(transcript_id, data)
+
+    def parse_model_output(self, transcript_id: str, output: dict) -> AnalysisResult:
+        """Build a result from a batch-inference modelOutput payload."""
+        for block in output.get("content", []):
+            if block.get("type") == "tool_use":
+                return self._result_from_dict(transcript_id, block.get("input", {}))
+        text = "".join(block.get("text", "") for block in output.get("content", []))
+        return self.parse_response(transcript_id, text)
+
+    async def analyze(self, transcript: Transcript) -> AnalysisResult:
+        payload = await self.client.ainvoke_model(
+            self._transcript_block(transcript),
+            self.SYSTEM_PROMPT,
+            cached_prefix=self._instructions,
+            max_tokens=self.MAX_TOKENS,
+            model_id=self.MODEL_ID,
+            tool_spec=self.TOOL_SPEC,
+        )
+        if not isinstance(payload, dict):
+            return self.parse_response(transcript.transcript_id, payload)
+        return self._result_from_dict(transcript.transcript_id, payload)
+
+    async def analyze_batch(
+        self, transcripts: List[Transcript]
+    ) -> Tuple[List[AnalysisResult], List[Transcript]]:
+        """Analyze several transcripts in one invocation.
+
+        Packing a small batch into one prompt amortizes the fixed instruction
+        and category-list tokens across every transcript in the batch.
+
+        Returns the parsed results plus the transcripts the model omitted
+        from its results array. Omitted transcripts produced no analysis at
+        all, so the caller must record them as failures for a later retry;
+        checkpointing a defaulted result would mark them processed forever.
+        (``_result_from_dict`` defaults still apply to entries that are
+        present but missing individual fields.)
+        """
+        payload = await self.client.ainvoke_model(
+            self._case_blocks(transcripts),
+            self.SYSTEM_PROMPT,
+            cached_prefix=self._batch_instructions,
+            max_tokens=self.MAX_TOKENS * len(transcripts),
+            model_id=self.MODEL_ID,
+            tool_spec=self.BATCH_TOOL_SPEC,
+        )
+        if isinstance(payload, dict):
+            entries = payload.get("results", [])
+        else:
+            try:
+                entries = _parse_json_response(payload)
+            except orjson.JSONDecodeError:
+                logger.warning(
+                    "Malformed JSON for batch %s",
+                    [t.transcript_id for t in transcripts],
+                )
+                entries = []
+        by_id = {
+            entry.get("transcript_id"): entry
+            for entry in entries
+            if isinstance(entry, dict)
+        }
+        results, missing = [], []
+        for transcript in transcripts:
+            entry = by_id.get(transcript.transcript_id)
+            if entry is None:
+                missing.append(transcript)
+            else:
+                results.append(self._result_from_dict(transcript.transcript_id, entry))
+        if missing:
+            logger.warning(
+                "Model omitted %d of %d cases from batch response: %s",
+                len(missing),
+                len(transcripts),
+                [t.transcript_id for t in missing],
+            )
+        return results, missing
+
+
+class LocalNormalizationAgent:
+    """Folds near-duplicate root-cause categories into canonical labels.
+
+    Runs entirely locally: each unique label is embedded once with a small
+    sentence-transformer and near-duplicates are merged by agglomerative
+    clustering on cosine distance. Unlike the old LLM batches of 50, the
+    clustering sees every label at once, so the same synonym can never map
+    to different canonicals across batches - and it costs zero Bedrock calls.
+    """
+
+    def __init__(
+        self,
+        model_name: str = config.EMBEDDING_MODEL,
+        distance_threshold: float = config.NORMALIZATION_DISTANCE_THRESHOLD,
+    ):
+        # Imported lazily: heavy dependencies only needed for this pass.
+        from sentence_transformers import SentenceTransformer
+
+        self._model = SentenceTransformer(model_name)
+        self._distance_threshold = distance_threshold
+
+    def normalize_categories(
+        self,
+        categories: List[str],
+        preferred_labels: Optional[List[str]] = None,
+    ) -> Dict[str, str]:
+        """Return a raw-label -> canonical-label mapping for ``categories``.
+
+        ``preferred_labels`` are treated like the recommended categories
+        when picking each cluster\'s canonical, so labels already
+        established in a persisted mapping stay stable across runs.
+        """
+        if len(categories) < 2:
+            return {category: category for category in categories}
+        from sklearn.cluster import AgglomerativeClustering
+
+        embeddings = self._model.encode(categories, normalize_embeddings=True)
+        labels = AgglomerativeClustering(
+            n_clusters=None,
+            distance_threshold=self._distance_threshold,
+            metric="cosine",
+            linkage="average",
+        ).fit_predict(embeddings)
+
+        clusters: Dict[int, List[str]] = {}
+        for category, label in zip(categories, labels):
+            clusters.setdefault(label, []).append(category)
+
+        preferred = set(config.RECOMMENDED_CATEGORIES) | set(preferred_labels or ())
+        mapping = {}
+        for members in clusters.values():
+            # Prefer a recommended/established label if the cluster contains
+            # one, otherwise the shortest member (ties broken alphabetically).
+            canonical = min(
+                members,
+                key=lambda m: (m not in preferred, len(m), m),
+            )
+            for member in members:
+                mapping[member] = canonical
+        return mapping
+
+
+class AggregationAgent:
+    """Produces the executive summary over the aggregated results."""
+
+    SYSTEM_PROMPT = (
+        "You are a senior operations analyst writing for leadership. "
+        "Be concise and concrete."
+    )
+
+    MODEL_ID = config.AGGREGATION_MODEL
+
+    def __init__(self, client: BedrockClient):
+        # Same contract as CombinedAnalysisAgent: an entered, shared client.
+        self.client = client
+
+    async def aggregate_results(
+        self,
+        root_cause_counts: Dict[str, int],
+        sentiment_counts: Dict[str, int],
+        sample_summaries: List[str],
+    ) -> str:
+        # The long tail of rare categories is noise the model ignores but
+        # still pays input tokens for; send the top categories plus one
+        # "__other__" bucket, and clip each sample summary.
+        top = Counter(root_cause_counts).most_common(config.AGGREGATION_TOP_CATEGORIES)
+        trimmed_counts = dict(top)
+        other = sum(root_cause_counts.values()) - sum(trimmed_counts.values())
+        if other:
+            trimmed_counts["__other__"] = other
+        samples = "\n".join(
+            f"- {s[:config.SAMPLE_TRUNCATE_CHARS]}" for s in sample_summaries
+        )
+        prompt = f"""Here are aggregated results from analyzing roadside-assistance
+call transcripts.
+
+Root cause counts (top {config.AGGREGATION_TOP_CATEGORIES}; "__other__" is the
+combined long tail):
+{json.dumps(trimmed_counts, indent=2)}
+
+Sentiment counts:
+{json.dumps(sentiment_counts, indent=2)}
+
+Sample call summaries:
+{samples}
+
+Write an executive summary (3-5 paragraphs) covering the dominant root
+causes, notable sentiment patterns, and the top recommended actions."""
+        return await self.client.ainvoke_model(
+            prompt, self.SYSTEM_PROMPT, model_id=self.MODEL_ID
+        )
@@ -0,0 +1,101 @@
+"""Configuration for the transcript analysis pipeline."""
+
+import os
+
+AWS_REGION = "us-east-1"
+
+# Model routing: every call names the cheapest model capable of its task.
+# Mechanical extraction-style work fits Haiku at ~1/12 the cost of Sonnet
+# (e.g. "anthropic.claude-3-haiku-20240307-v1:0"); the combined analysis
+# and executive summary both need judgment, so they stay on Sonnet.
+ANALYSIS_MODEL = "anthropic.claude-3-5-sonnet-20241022-v2:0"
+AGGREGATION_MODEL = "anthropic.claude-3-5-sonnet-20241022-v2:0"
+
+# Client-side rate limiting: the bucket admits TPM_QUOTA / AVG_TOKENS_PER_CALL
+# calls per minute, keeping steady-state throughput pinned just under the
+# account quota instead of relying on ThrottlingException retries.
+TPM_QUOTA = 1_000_000
+AVG_TOKENS_PER_CALL = 4_000
+
+# Records between checkpoint flush+fsync in the writer task.
+CHECKPOINT_FSYNC_EVERY = 100
+
+# Records between persisted updates of the checkpoint meta sidecar.
+META_UPDATE_EVERY = 1000
+
+# In-flight Bedrock calls on the event loop; each is pure network I/O, so
+# this can sit far higher than the old thread-pool worker count.
+MAX_CONCURRENCY = 40
+TEMPERATURE = 0.0
+
+# Request Bedrock's latency-optimized serving tier for live calls. Only a
+# handful of models support it; requests against any other model are gated
+# off the allowlist below, since Bedrock rejects them with a (non-retryable)
+# ValidationException rather than ignoring the setting.
+LATENCY_OPTIMIZED = True
+LATENCY_OPTIMIZED_MODEL_PREFIXES = (
+    "anthropic.claude-3-5-haiku",
+    "meta.llama3-1-70b",
+    "meta.llama3-1-405b",
+)
+
+# Transcripts longer than TRANSCRIPT_TOKEN_LIMIT tokens are clipped to the
+# first TRANSCRIPT_HEAD_TOKENS plus the last TRANSCRIPT_TAIL_TOKENS before
+# prompt construction; the omitted middle is marked in the prompt.
+TRANSCRIPT_TOKEN_LIMIT = 2000
+TRANSCRIPT_HEAD_TOKENS = 1200
+TRANSCRIPT_TAIL_TOKENS = 600
+
+# Transcripts packed into one prompt. Amortizes the fixed instruction and
+# category-list tokens across the batch; keep small so attention quality on
+# long transcripts holds up.
+BATCH_SIZE = 5
+
+
+INPUT_FILE = "transcripts.json"
+CHECKPOINT_FILE = "checkpoint.jsonl"
+CHECKPOINT_PARQUET = "checkpoint.parquet"
+CHECKPOINT_META_FILE = "checkpoint.meta.json"
+CATEGORY_MAPPING_FILE = "category_mapping.json"
+FAILURES_FILE = "failures.jsonl"
+OUTPUT_FILE = "analysis_output.json"
+DETAILED_RESULTS_FILE = "detailed_results.jsonl"
+
+# Local category normalization: embed each unique label once and merge
+# near-duplicates by cosine distance. No Bedrock calls involved.
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+NORMALIZATION_DISTANCE_THRESHOLD = 0.2
+
+# Bedrock batch inference (``--mode batch``). Roughly half the on-demand
+# price and no TPM contention; latency-tolerant bulk runs should prefer it.
+S3_BUCKET = os.environ.get("ANALYSIS_S3_BUCKET", "network-traffic-analysis")
+S3_BATCH_PREFIX = "bedrock-batch"
+BATCH_ROLE_ARN = os.environ.get("BEDROCK_BATCH_ROLE_ARN", "")
+BATCH_POLL_SECONDS = 60
+SAMPLE_SUMMARY_LIMIT = 40
+
+# Aggregation prompt trimming: categories beyond the top K collapse into a
+# single "__other__" bucket, and sample summaries are clipped per entry.
+AGGREGATION_TOP_CATEGORIES = 15
+SAMPLE_TRUNCATE_CHARS = 200
+
+# Seed categories shown to the model, each with the one-line definition used
+# in the prompt; it may still emit novel categories, which the normalization
+# pass folds back into canonical labels.
+CATEGORY_DESCRIPTIONS = {
+    "Flat Tire": "damaged, punctured, or deflated tires",
+    "Dead Battery": "battery needs a jump start or replacement",
+    "Vehicle Lockout": "keys locked in, lost, or fob/lock broken",
+    "Towing Required": "vehicle must be transported to a shop or home",
+    "Fuel Delivery": "out of fuel, or the wrong fuel was added",
+    "Engine Breakdown": "mechanical or electrical failure; undrivable",
+    "Accident / Collision": "assistance needed after a crash",
+    "Stuck Vehicle": "immobilized in mud, snow, sand, or a ditch",
+    "Provider Delay": "provider arrived far later than quoted",
+    "Provider No-Show": "the assigned provider never arrived",
+    "Billing / Coverage Dispute": "charges, refunds, or coverage disagreements",
+    "App / Technical Issue": "app, website, phone-system, or GPS problems",
+    "Cancellation": "the customer or provider cancelled the request",
+    "Other": "no category above describes the root cause",
+}
+RECOMMENDED_CATEGORIES = list(CATEGORY_DESCRIPTIONS)
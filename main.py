@@ -1 +1,595 @@
+"""Analyze roadside-assistance call transcripts with Bedrock.
 
+Pipeline:
+  1. Load transcripts and skip anything already in the checkpoint.
+  2. Run the combined timeline + root-cause analysis per batch of
+     transcripts on an asyncio event loop, appending each result to the
+     checkpoint as it completes.
+  3. Normalize the raw root-cause categories into canonical labels.
+  4. Aggregate counts and produce an executive summary.
+"""
+
+import argparse
+import asyncio
+import logging
+import io
+import mmap
+import os
+import re
+import shutil
+import time
+from collections import Counter, deque
+from typing import Dict, List, Optional, Set, Tuple
+
+import boto3
+import msgspec
+import orjson
+import polars as pl
+
+import config
+from agents import (
+    AggregationAgent,
+    AnalysisResult,
+    BedrockClient,
+    CombinedAnalysisAgent,
+    LocalNormalizationAgent,
+    Transcript,
+)
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+class CheckpointWriter:
+    """Single consumer for checkpoint and failure appends.
+
+    Producers enqueue encoded lines and never touch the files. One drain
+    task owns both file handles, opened once with a 1MB buffer, and
+    flushes+fsyncs every CHECKPOINT_FSYNC_EVERY records. This replaces the
+    old open-write-close per result under a lock: appends become an
+    uncontended queue put, and the open() syscall is paid once per run.
+    Buffered writes are memory copies, so draining on the event loop is
+    fine; only the periodic fsync touches the disk.
+    """
+
+    def __init__(self):
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    def write_result(self, result: AnalysisResult) -> None:
+        self._queue.put_nowait(
+            (config.CHECKPOINT_FILE, msgspec.json.encode(result) + b"\n")
+        )
+
+    def write_failure(self, transcript_id: str, error: Exception) -> None:
+        self._queue.put_nowait(
+            (
+                config.FAILURES_FILE,
+                orjson.dumps({"transcript_id": transcript_id, "error": str(error)})
+                + b"\n",
+            )
+        )
+
+    async def __aenter__(self) -> "CheckpointWriter":
+        self._task = asyncio.create_task(self._drain())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self._queue.put_nowait(None)
+        await self._task
+
+    async def _drain(self) -> None:
+        files = {}
+        pending = 0
+        try:
+            while True:
+                item = await self._queue.get()
+                if item is None:
+                    break
+                path, line = item
+                f = files.get(path)
+                if f is None:
+                    f = files[path] = open(path, "ab", buffering=1 << 20)
+                f.write(line)
+                pending += 1
+                if pending >= config.CHECKPOINT_FSYNC_EVERY:
+                    for handle in files.values():
+                        handle.flush()
+                        os.fsync(handle.fileno())
+                    pending = 0
+        finally:
+            for handle in files.values():
+                handle.flush()
+                os.fsync(handle.fileno())
+                handle.close()
+
+
+class RunAccumulator:
+    """Running totals over everything in the checkpoint.
+
+    Seeded with the counts from previous runs, then updated as each fresh
+    result is checkpointed, so aggregation never has to re-read what this
+    run just wrote. The totals are persisted to a small sidecar
+    (checkpoint.meta.json) every META_UPDATE_EVERY records and at the end
+    of the run; a later run whose sidecar matches the checkpoint record
+    count can skip the replay scan entirely.
+    """
+
+    def __init__(
+        self,
+        raw_category_counts: Optional[Counter] = None,
+        sentiment_counts: Optional[Counter] = None,
+        sample_summaries: Optional[List[str]] = None,
+        total_processed: int = 0,
+    ):
+        self.raw_category_counts = Counter(raw_category_counts or {})
+        self.sentiment_counts = Counter(sentiment_counts or {})
+        self.sample_summaries = deque(
+            sample_summaries or [], maxlen=config.SAMPLE_SUMMARY_LIMIT
+        )
+        self.total_processed = total_processed
+
+    def add(self, result: AnalysisResult) -> None:
+        self.raw_category_counts[result.root_cause_category] += 1
+        self.sentiment_counts[result.sentiment] += 1
+        if result.summary:
+            self.sample_summaries.append(result.summary)
+        self.total_processed += 1
+        if self.total_processed % config.META_UPDATE_EVERY == 0:
+            self.write_meta()
+
+    def write_meta(self) -> None:
+        payload = orjson.dumps(
+            {
+                "total_processed": self.total_processed,
+                "root_cause_category_counts": dict(self.raw_category_counts),
+                "sentiment_counts": dict(self.sentiment_counts),
+                "sample_summaries": list(self.sample_summaries),
+            }
+        )
+        with open(config.CHECKPOINT_META_FILE, "wb") as f:
+            f.write(payload)
+
+
+def load_transcripts(file_path: str) -> List[Transcript]:
+    with open(file_path, "rb") as f:
+        return msgspec.json.decode(f.read(), type=List[Transcript])
+
+
+def repair_torn_tail(file_path: str) -> None:
+    """Drop a partially written final line left behind by a hard kill.
+
+    The writer appends through a large userspace buffer that flushes at
+    arbitrary byte boundaries, so SIGKILL or an OOM kill can leave a torn
+    record at EOF. The append-only logs only work as write-ahead logs if
+    every line is complete: left in place, the torn fragment gets glued to
+    the first record of the next run. Truncate to the last newline before
+    anything reads or appends.
+    """
+    try:
+        f = open(file_path, "r+b")
+    except FileNotFoundError:
+        return
+    with f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            return
+        with mm:
+            size = mm.size()
+            if mm[size - 1 : size] == b"\n":
+                return
+            keep = mm.rfind(b"\n") + 1
+        logger.warning(
+            "Dropping %d bytes of torn trailing record from %s",
+            size - keep,
+            file_path,
+        )
+        f.truncate(keep)
+
+
+_TRANSCRIPT_ID_RE = re.compile(rb'"transcript_id"\s*:\s*"([^"]+)"')
+
+
+def load_processed_ids() -> Set[str]:
+    """Collect transcript IDs already present in the checkpoint.
+
+    ``transcript_id`` sits near the start of every checkpoint record, so a
+    regex scan over an mmap recovers the IDs roughly an order of magnitude
+    faster than parsing each line as JSON. If any record fails to match,
+    fall back to the full per-line parse.
+    """
+    try:
+        f = open(config.CHECKPOINT_FILE, "rb")
+    except FileNotFoundError:
+        return set()
+    with f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty checkpoint
+            return set()
+        with mm:
+            matches = _TRANSCRIPT_ID_RE.findall(mm)
+            # Count non-empty lines without materializing them.
+            records = 0
+            prev = -1
+            pos = mm.find(b"\n")
+            while pos != -1:
+                if pos - prev > 1:
+                    records += 1
+                prev = pos
+                pos = mm.find(b"\n", prev + 1)
+            if mm.size() - prev > 1:
+                records += 1  # final record without trailing newline
+    if len(matches) == records:
+        return {m.decode() for m in matches}
+
+    logger.warning("Checkpoint regex scan missed %d records, re-parsing",
+                   records - len(matches))
+    processed = set()
+    with open(config.CHECKPOINT_FILE, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                processed.add(orjson.loads(line)["transcript_id"])
+            except orjson.JSONDecodeError:
+                # A malformed line cannot mark anything processed; skip it
+                # rather than abort resumption of an interrupted run.
+                logger.warning("Skipping malformed checkpoint line")
+    return processed
+
+
+async def batch_wrapper(
+    agent: CombinedAnalysisAgent,
+    batch: List[Transcript],
+    semaphore: asyncio.Semaphore,
+    writer: CheckpointWriter,
+    accumulator: RunAccumulator,
+) -> None:
+    """Analyze a batch in one Bedrock call and checkpoint each result."""
+    async with semaphore:
+        try:
+            results, missing = await agent.analyze_batch(batch)
+        except Exception as e:  # noqa: BLE001 - one bad batch must not kill the run
+            for transcript in batch:
+                logger.error("Failed to process %s: %s", transcript.transcript_id, e)
+                writer.write_failure(transcript.transcript_id, e)
+            return
+    # Transcripts the model left out of its response carry no analysis;
+    # recording them as failures keeps them eligible for retry on the next
+    # run instead of checkpointing fabricated defaults.
+    for transcript in missing:
+        writer.write_failure(
+            transcript.transcript_id,
+            RuntimeError("omitted from batch response"),
+        )
+    for result in results:
+        writer.write_result(result)
+        accumulator.add(result)
+
+
+def chunks(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def _counts_from_frame(df: "pl.DataFrame") -> Tuple[Counter, Counter, List[str]]:
+    """Category/sentiment counts and sample summaries via Polars groupby."""
+    raw_category_counts = Counter(
+        dict(df.group_by("root_cause_category").len().iter_rows())
+    )
+    sentiment_counts = Counter(dict(df.group_by("sentiment").len().iter_rows()))
+    summaries = df.get_column("summary").drop_nulls()
+    samples = (
+        summaries.filter(summaries != "").head(config.SAMPLE_SUMMARY_LIMIT).to_list()
+    )
+    return raw_category_counts, sentiment_counts, samples
+
+
+def aggregate_checkpoint(
+    file_path: str, limit: Optional[int] = None
+) -> Tuple[Counter, Counter, List[str]]:
+    """Aggregate checkpoint records with Polars groupby kernels.
+
+    Returns raw category counts (normalization is applied afterwards),
+    sentiment counts, and sample summaries. Only the three needed columns
+    are parsed, and counting happens in Polars\' parallel Arrow-backed
+    group_by instead of a per-line Python loop. ``limit`` bounds the scan
+    to the first N bytes: the checkpoint is append-only, so the file size
+    captured at startup delimits exactly the records from previous runs.
+    """
+    with open(file_path, "rb") as f:
+        payload = f.read() if limit is None else f.read(limit)
+    df = pl.read_ndjson(
+        io.BytesIO(payload),
+        schema={
+            "root_cause_category": pl.Utf8,
+            "sentiment": pl.Utf8,
+            "summary": pl.Utf8,
+        },
+    )
+    return _counts_from_frame(df)
+
+
+def load_prior_counts(
+    prior_bytes: int, expected_records: int
+) -> Tuple[Counter, Counter, List[str]]:
+    """Counts for the records written by previous runs.
+
+    The meta sidecar written alongside the checkpoint carries exactly these
+    totals; when its record count matches the IDs found at startup, no
+    checkpoint bytes need to be read at all. Otherwise fall through to the
+    snapshot/JSONL replay.
+    """
+    try:
+        with open(config.CHECKPOINT_META_FILE, "rb") as f:
+            meta = orjson.loads(f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        meta = None
+    if meta and meta.get("total_processed") == expected_records:
+        return (
+            Counter(meta.get("root_cause_category_counts", {})),
+            Counter(meta.get("sentiment_counts", {})),
+            meta.get("sample_summaries", []),
+        )
+    if not prior_bytes:
+        return Counter(), Counter(), []
+    return replay_prior_runs(prior_bytes, expected_records)
+
+
+def replay_prior_runs(
+    prior_bytes: int, expected_records: int
+) -> Tuple[Counter, Counter, List[str]]:
+    """Counts for the records written by previous runs.
+
+    Prefers the columnar snapshot written at the end of the last run:
+    zstd Parquet is several times smaller than the JSONL and the scan
+    touches only the three needed columns. Falls back to replaying the
+    JSONL prefix when the snapshot is missing or stale (the record count
+    is checked against the IDs found at startup, so a run that crashed
+    before snapshotting cannot leave us with silently short counts).
+    """
+    if os.path.exists(config.CHECKPOINT_PARQUET):
+        df = (
+            pl.scan_parquet(config.CHECKPOINT_PARQUET)
+            .select("root_cause_category", "sentiment", "summary")
+            .collect()
+        )
+        if df.height == expected_records:
+            return _counts_from_frame(df)
+        logger.warning(
+            "Parquet snapshot has %d records, expected %d; replaying JSONL",
+            df.height, expected_records,
+        )
+    return aggregate_checkpoint(config.CHECKPOINT_FILE, limit=prior_bytes)
+
+
+def load_category_mapping() -> Dict[str, str]:
+    try:
+        with open(config.CATEGORY_MAPPING_FILE, "rb") as f:
+            return orjson.loads(f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {}
+
+
+def save_category_mapping(mapping: Dict[str, str]) -> None:
+    with open(config.CATEGORY_MAPPING_FILE, "wb") as f:
+        f.write(orjson.dumps(mapping, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
+
+
+def write_parquet_snapshot() -> None:
+    """Convert the JSONL write-ahead checkpoint into a Parquet snapshot.
+
+    JSONL stays the append-only format during processing (crash-safe,
+    append-friendly); the snapshot exists so the next run can replay prior
+    results from a compressed columnar file instead of re-parsing JSON.
+    """
+    try:
+        pl.read_ndjson(config.CHECKPOINT_FILE).write_parquet(
+            config.CHECKPOINT_PARQUET, compression="zstd"
+        )
+    except FileNotFoundError:
+        pass
+
+
+async def run_batch_inference(
+    agent: CombinedAnalysisAgent,
+    to_process: List[Transcript],
+    writer: CheckpointWriter,
+    accumulator: RunAccumulator,
+) -> None:
+    """Process transcripts through a Bedrock batch-inference job.
+
+    Writes a JSONL manifest (one record per transcript) to S3, submits a
+    model-invocation job, polls until it finishes, then feeds the output
+    records through the same checkpoint path as live mode. The job is a
+    single serial workflow, so plain boto3 clients are fine here.
+    """
+    s3 = boto3.client("s3", region_name=config.AWS_REGION)
+    bedrock = boto3.client("bedrock", region_name=config.AWS_REGION)
+
+    job_name = f"transcript-analysis-{int(time.time())}"
+    input_key = f"{config.S3_BATCH_PREFIX}/input/{job_name}.jsonl"
+    output_prefix = f"{config.S3_BATCH_PREFIX}/output/"
+
+    manifest = b"".join(
+        orjson.dumps(
+            {
+                "recordId": transcript.transcript_id,
+                "modelInput": agent.build_model_input(transcript),
+            }
+        )
+        + b"\n"
+        for transcript in to_process
+    )
+    s3.put_object(Bucket=config.S3_BUCKET, Key=input_key, Body=manifest)
+    logger.info("Uploaded manifest with %d records to s3://%s/%s",
+                len(to_process), config.S3_BUCKET, input_key)
+
+    job = bedrock.create_model_invocation_job(
+        jobName=job_name,
+        roleArn=config.BATCH_ROLE_ARN,
+        modelId=config.ANALYSIS_MODEL,
+        inputDataConfig={
+            "s3InputDataConfig": {
+                "s3Uri": f"s3://{config.S3_BUCKET}/{input_key}"
+            }
+        },
+        outputDataConfig={
+            "s3OutputDataConfig": {
+                "s3Uri": f"s3://{config.S3_BUCKET}/{output_prefix}"
+            }
+        },
+    )
+    job_arn = job["jobArn"]
+
+    while True:
+        status = bedrock.get_model_invocation_job(jobIdentifier=job_arn)["status"]
+        logger.info("Batch job %s: %s", job_name, status)
+        if status in ("Completed", "Failed", "Stopped"):
+            break
+        await asyncio.sleep(config.BATCH_POLL_SECONDS)
+    if status != "Completed":
+        raise RuntimeError(f"Batch job {job_name} ended with status {status}")
+
+    job_id = job_arn.split("/")[-1]
+    listing = s3.list_objects_v2(
+        Bucket=config.S3_BUCKET, Prefix=f"{output_prefix}{job_id}/"
+    )
+    for obj in listing.get("Contents", []):
+        if not obj["Key"].endswith(".jsonl.out"):
+            continue
+        body = s3.get_object(Bucket=config.S3_BUCKET, Key=obj["Key"])["Body"]
+        for line in body.iter_lines():
+            record = orjson.loads(line)
+            record_id = record["recordId"]
+            output = record.get("modelOutput")
+            if not output:
+                writer.write_failure(
+                    record_id, RuntimeError(record.get("error", "no output"))
+                )
+                continue
+            result = agent.parse_model_output(record_id, output)
+            writer.write_result(result)
+            accumulator.add(result)
+
+
+async def async_main(args: argparse.Namespace) -> None:
+    # An interrupted run may have torn the final line of the append-only
+    # logs; repair them before they are read or appended to.
+    repair_torn_tail(config.CHECKPOINT_FILE)
+    repair_torn_tail(config.FAILURES_FILE)
+    transcripts = load_transcripts(args.input)
+    processed_ids = load_processed_ids()
+    to_process = [t for t in transcripts if t.transcript_id not in processed_ids]
+    logger.info(
+        "Loaded %d transcripts, %d already processed, %d to go",
+        len(transcripts), len(processed_ids), len(to_process),
+    )
+    # Everything before this offset in the append-only checkpoint belongs to
+    # previous runs; only that prefix needs replaying during aggregation.
+    try:
+        prior_bytes = os.path.getsize(config.CHECKPOINT_FILE)
+    except FileNotFoundError:
+        prior_bytes = 0
+
+    prior_categories, prior_sentiments, prior_samples = load_prior_counts(
+        prior_bytes, len(processed_ids)
+    )
+    accumulator = RunAccumulator(
+        prior_categories, prior_sentiments, prior_samples, len(processed_ids)
+    )
+    async with BedrockClient() as client:
+        analysis_agent = CombinedAnalysisAgent(client)
+        async with CheckpointWriter() as writer:
+            if args.mode == "batch":
+                if to_process:
+                    await run_batch_inference(
+                        analysis_agent, to_process, writer, accumulator
+                    )
+            else:
+                semaphore = asyncio.Semaphore(config.MAX_CONCURRENCY)
+                batches = list(chunks(to_process, config.BATCH_SIZE))
+                tasks = [
+                    batch_wrapper(analysis_agent, batch, semaphore, writer, accumulator)
+                    for batch in batches
+                ]
+                for i, task in enumerate(asyncio.as_completed(tasks), 1):
+                    await task
+                    if i % 20 == 0:
+                        logger.info("Processed %d/%d batches", i, len(tasks))
+
+        # Snapshot the full checkpoint for the next run's replay and pin the
+        # sidecar to the exact final totals.
+        write_parquet_snapshot()
+        accumulator.write_meta()
+
+        raw_category_counts = accumulator.raw_category_counts
+        sentiment_counts = accumulator.sentiment_counts
+        sample_summaries = list(accumulator.sample_summaries)
+        logger.info(
+            "Found %d unique root-cause categories", len(raw_category_counts)
+        )
+
+        # The persisted mapping only grows: cluster just the labels this run
+        # introduced, alongside the established canonicals so new synonyms
+        # attach to them rather than spawning fresh labels.
+        category_mapping = load_category_mapping()
+        new_categories = sorted(set(raw_category_counts) - set(category_mapping))
+        if new_categories:
+            known_canonicals = sorted(set(category_mapping.values()))
+            delta_mapping = LocalNormalizationAgent().normalize_categories(
+                new_categories + known_canonicals,
+                preferred_labels=known_canonicals,
+            )
+            for category in new_categories:
+                category_mapping[category] = delta_mapping.get(category, category)
+            save_category_mapping(category_mapping)
+        root_cause_counts: Counter = Counter()
+        for raw_category, count in raw_category_counts.items():
+            root_cause_counts[category_mapping.get(raw_category, raw_category)] += count
+
+        aggregation_agent = AggregationAgent(client)
+        executive_summary = await aggregation_agent.aggregate_results(
+            dict(root_cause_counts), dict(sentiment_counts), sample_summaries
+        )
+
+    # Per-transcript results already live in the checkpoint; re-serializing
+    # them into the summary JSON tripled its size for no reader's benefit.
+    # Consumers that want the full records get a byte-for-byte copy instead.
+    final_output = {
+        "total_transcripts": sum(sentiment_counts.values()),
+        "root_cause_counts": dict(root_cause_counts),
+        "sentiment_counts": dict(sentiment_counts),
+        "executive_summary": executive_summary,
+    }
+    try:
+        shutil.copyfile(config.CHECKPOINT_FILE, config.DETAILED_RESULTS_FILE)
+        final_output["detailed_results_file"] = config.DETAILED_RESULTS_FILE
+    except FileNotFoundError:
+        # Nothing was ever processed, so no checkpoint exists; the summary
+        # then carries no detailed-results pointer.
+        pass
+    with open(config.OUTPUT_FILE, "wb") as f:
+        f.write(orjson.dumps(final_output, option=orjson.OPT_INDENT_2))
+    logger.info("Wrote %s", config.OUTPUT_FILE)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--input", default=config.INPUT_FILE)
+    parser.add_argument(
+        "--mode",
+        choices=("live", "batch"),
+        default="live",
+        help="live: on-demand calls on the event loop; "
+        "batch: Bedrock batch-inference job (cheaper, latency-tolerant)",
+    )
+    args = parser.parse_args()
+    asyncio.run(async_main(args))
+
+
+if __name__ == "__main__":
+    main()